@@ -1,27 +1,85 @@
 # -*- coding: utf-8 -*-
 """
-Generates a Cyber Threat Intelligence (CTI) report in two parts with an interval,
-including a Mermaid diagram and a chat interface for further interaction with Gemini,
+Generates a Cyber Threat Intelligence (CTI) report in two parts, together with
+a Mermaid diagram and a chat interface for further interaction with Gemini,
 based on analysis scripts provided in a specified input directory.
+The generation requests are sent concurrently ("interactive" mode), through the
+Gemini Batch API ("batch" mode) or one after another ("legacy" mode). Rate limits are
+handled by retrying after the delay the API asks for rather than by fixed pauses.
 Configuration is loaded from config.yaml.
 """
 
 import google.generativeai as genai
+import asyncio
+import tenacity
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import functools
+import hashlib
+import json
+import math
 import os
 import glob
+import pickle
+import re
 import sys
+import tempfile
 import time
+import weakref
 import yaml
-from datetime import datetime
+from datetime import datetime, timedelta
+from google.api_core import exceptions as google_exceptions
+from prompt_toolkit import PromptSession
+from prompt_toolkit.patch_stdout import patch_stdout
+
+# Use the libyaml-based C loader when PyYAML was built with it; it is much faster
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 # --- Load Configuration ---
 CONFIG_FILE = "config.yaml"
+GENERATION_MODES = ("interactive", "batch", "legacy")
+# Directory for data cached between runs (e.g. the combined script content)
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cti-report")
+# Stands in for {script_content} in the prompt templates when the scripts are in a context cache
+CACHED_SCRIPT_CONTENT_NOTE = "[The combined analysis inputs are provided in the cached context of this conversation.]"
 
 def load_config(config_file):
-    """Loads configuration from a YAML file."""
+    """Loads configuration from a YAML file.
+
+    The parsed configuration is cached next to the file as JSON (config_file + ".json.cache")
+    and reused as long as the YAML file's modification time and size are unchanged.
+    """
+    cache_file = config_file + ".json.cache"
     try:
+        st = os.stat(config_file)
+        signature = [st.st_mtime_ns, st.st_size]
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached["sig"] == signature:
+                print(f"Configuration loaded from {config_file} (cached)")
+                return cached["data"]
+        except (OSError, ValueError, TypeError, KeyError):
+            pass # No usable cache, parse the YAML file below
+
         with open(config_file, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
+            config = yaml.load(f, Loader=SafeLoader)
+        try:
+            # Only cache configurations that survive a JSON round trip unchanged (e.g. no dates)
+            serialized = json.dumps({"sig": signature, "data": config})
+            if json.loads(serialized)["data"] == config:
+                temp_file = f"{cache_file}.{os.getpid()}.tmp"
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    f.write(serialized)
+                os.replace(temp_file, cache_file)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Warning: Could not cache configuration to {cache_file}: {e}")
         print(f"Configuration loaded from {config_file}")
         return config
     except FileNotFoundError:
@@ -55,14 +113,247 @@ except Exception as e:
     sys.exit(1)
 
 
-# --- Function to Load Script Files ---
-def load_scripts(directory, pattern):
-    """Loads content from script files matching a pattern in a directory."""
-    script_contents = []
+# --- Functions to Read Script Files ---
+IO_BACKENDS = ("threads", "io_uring")
+IO_URING_QUEUE_DEPTH = 256
+IORING_SETUP_SQPOLL = 1 << 1
+IORING_ASYNC_CANCEL_ANY = 1 << 2
+IO_URING_CANCEL_USER_DATA = (1 << 64) - 1 # Marks the completion of the cancel request itself
+# Buffers of reads that could not be reaped; kept alive so the kernel never writes into freed memory
+_ABANDONED_IO_URING_BUFFERS = []
+
+def _read_one(file_path):
+    """Reads a single script file as bytes, returning (path, bytes, error)."""
+    try:
+        with open(file_path, 'rb') as f:
+            return file_path, f.read(), None
+    except Exception as e:
+        return file_path, None, e
+
+def _read_files_threaded(file_paths):
+    """Reads files on a thread pool so several reads are in flight at once, keeping their order."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(file_paths))) as executor:
+        return list(executor.map(_read_one, file_paths))
+
+class _IoUringCqe(ctypes.Structure):
+    """Leading fields of liburing's struct io_uring_cqe."""
+    _fields_ = [("user_data", ctypes.c_uint64), ("res", ctypes.c_int32), ("flags", ctypes.c_uint32)]
+
+def _load_liburing():
+    """Loads liburing-ffi, which exports liburing's inline helpers for use through ctypes."""
+    library_path = ctypes.util.find_library("uring-ffi") or "liburing-ffi.so.2"
+    lib = ctypes.CDLL(library_path, use_errno=True)
+    ring_p, sqe_p = ctypes.c_void_p, ctypes.c_void_p
+    cqe_pp = ctypes.POINTER(ctypes.POINTER(_IoUringCqe))
+    lib.io_uring_queue_init.argtypes = [ctypes.c_uint, ring_p, ctypes.c_uint]
+    lib.io_uring_queue_init.restype = ctypes.c_int
+    lib.io_uring_queue_exit.argtypes = [ring_p]
+    lib.io_uring_queue_exit.restype = None
+    lib.io_uring_get_sqe.argtypes = [ring_p]
+    lib.io_uring_get_sqe.restype = sqe_p
+    lib.io_uring_prep_read.argtypes = [sqe_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_uint64]
+    lib.io_uring_prep_read.restype = None
+    lib.io_uring_sqe_set_data64.argtypes = [sqe_p, ctypes.c_uint64]
+    lib.io_uring_sqe_set_data64.restype = None
+    lib.io_uring_submit.argtypes = [ring_p]
+    lib.io_uring_submit.restype = ctypes.c_int
+    lib.io_uring_wait_cqe.argtypes = [ring_p, cqe_pp]
+    lib.io_uring_wait_cqe.restype = ctypes.c_int
+    lib.io_uring_peek_batch_cqe.argtypes = [ring_p, cqe_pp, ctypes.c_uint]
+    lib.io_uring_peek_batch_cqe.restype = ctypes.c_uint
+    lib.io_uring_cq_advance.argtypes = [ring_p, ctypes.c_uint]
+    lib.io_uring_cq_advance.restype = None
+    if hasattr(lib, "io_uring_prep_cancel64"): # liburing 2.2+
+        lib.io_uring_prep_cancel64.argtypes = [sqe_p, ctypes.c_uint64, ctypes.c_int]
+        lib.io_uring_prep_cancel64.restype = None
+    return lib
+
+def _wait_io_uring_completions(lib, ring, cqes):
+    """Waits for at least one completion and returns the (user_data, res) of all ready ones.
+
+    The wait is restarted when a signal interrupts it (-EINTR).
+    """
+    while True:
+        ret = lib.io_uring_wait_cqe(ring, cqes)
+        if ret != -errno.EINTR:
+            break
+    if ret < 0:
+        raise OSError(-ret, os.strerror(-ret))
+    count = lib.io_uring_peek_batch_cqe(ring, cqes, IO_URING_QUEUE_DEPTH)
+    completions = [(cqes[i].contents.user_data, cqes[i].contents.res) for i in range(count)]
+    lib.io_uring_cq_advance(ring, count)
+    return completions
+
+def _drain_io_uring(lib, ring, cqes, in_flight):
+    """Cancels the reads still in flight and waits until the kernel is done with their buffers.
+
+    If the ring cannot be drained, the buffers are kept alive for the rest of the process instead.
+    """
+    cancel_pending = False
+    if hasattr(lib, "io_uring_prep_cancel64"):
+        sqe = lib.io_uring_get_sqe(ring)
+        if sqe:
+            lib.io_uring_prep_cancel64(sqe, 0, IORING_ASYNC_CANCEL_ANY)
+            lib.io_uring_sqe_set_data64(sqe, IO_URING_CANCEL_USER_DATA)
+            cancel_pending = True
+    try:
+        # Also submits any reads left queued by a failed submission, so every read completes
+        ret = lib.io_uring_submit(ring)
+        if ret < 0:
+            raise OSError(-ret, os.strerror(-ret))
+        while in_flight or cancel_pending:
+            for user_data, _ in _wait_io_uring_completions(lib, ring, cqes):
+                if user_data == IO_URING_CANCEL_USER_DATA:
+                    cancel_pending = False
+                elif user_data in in_flight:
+                    try:
+                        os.close(in_flight.pop(user_data)[0])
+                    except OSError:
+                        pass
+    except OSError as e:
+        print(f"Warning: Could not wait for pending io_uring reads ({e}).")
+        for fd, *buffers in in_flight.values():
+            _ABANDONED_IO_URING_BUFFERS.append(buffers)
+            try:
+                os.close(fd) # The kernel keeps its own reference to the open file
+            except OSError:
+                pass
+        in_flight.clear()
+
+def _read_files_io_uring(file_paths, sqpoll=False):
+    """Reads files with io_uring, submitting up to IO_URING_QUEUE_DEPTH reads per system call.
+
+    Returns a list of (path, bytes, error) in the order of file_paths, or None if io_uring is
+    not available (non-Linux system, missing liburing-ffi or kernel support).
+    """
+    try:
+        lib = _load_liburing()
+    except (OSError, AttributeError) as e:
+        print(f"Warning: io_uring backend unavailable ({e}), falling back to threaded reads.")
+        return None
+
+    # struct io_uring is treated as opaque; this is comfortably larger than any liburing version's layout
+    ring = ctypes.create_string_buffer(1024)
+    ret = lib.io_uring_queue_init(IO_URING_QUEUE_DEPTH, ring, IORING_SETUP_SQPOLL if sqpoll else 0)
+    if ret < 0 and sqpoll:
+        # SQPOLL needs elevated privileges on older kernels; retry with regular submission
+        print(f"Warning: Could not enable io_uring SQPOLL ({os.strerror(-ret)}), using regular submission.")
+        ret = lib.io_uring_queue_init(IO_URING_QUEUE_DEPTH, ring, 0)
+    if ret < 0:
+        print(f"Warning: io_uring setup failed ({os.strerror(-ret)}), falling back to threaded reads.")
+        return None
+
+    results = [None] * len(file_paths)
+    cqes = (ctypes.POINTER(_IoUringCqe) * IO_URING_QUEUE_DEPTH)()
+    in_flight = {}
+    try:
+        # Work through the files one queue's worth at a time to bound open descriptors
+        for window_start in range(0, len(file_paths), IO_URING_QUEUE_DEPTH):
+            in_flight = {} # index -> (fd, buffer, ctypes view of buffer, size)
+            for index in range(window_start, min(window_start + IO_URING_QUEUE_DEPTH, len(file_paths))):
+                file_path = file_paths[index]
+                try:
+                    fd = os.open(file_path, os.O_RDONLY)
+                except OSError as e:
+                    results[index] = (file_path, None, e)
+                    continue
+                try:
+                    size = os.fstat(fd).st_size
+                except OSError as e:
+                    os.close(fd)
+                    results[index] = (file_path, None, e)
+                    continue
+                if size == 0:
+                    os.close(fd)
+                    results[index] = (file_path, b"", None)
+                    continue
+                buffer = bytearray(size)
+                c_buffer = (ctypes.c_char * size).from_buffer(buffer)
+                sqe = lib.io_uring_get_sqe(ring)
+                lib.io_uring_prep_read(sqe, fd, ctypes.addressof(c_buffer), min(size, 0x7ffff000), 0)
+                lib.io_uring_sqe_set_data64(sqe, index)
+                in_flight[index] = (fd, buffer, c_buffer, size)
+
+            if in_flight:
+                ret = lib.io_uring_submit(ring)
+                if ret < 0:
+                    raise OSError(-ret, os.strerror(-ret))
+
+            while in_flight:
+                # Block for the first completion, then reap everything else that is already done
+                # These completions are already consumed from the ring, so take all of them out
+                # of in_flight before anything below can fail; dropping the ctypes view of each
+                # buffer also releases the export so the bytearray can be resized
+                reaped = [
+                    (index, res) + in_flight.pop(index)[:2]
+                    for index, res in _wait_io_uring_completions(lib, ring, cqes)
+                ]
+                for index, res, fd, buffer in reaped:
+                    file_path = file_paths[index]
+                    try:
+                        if res < 0:
+                            raise OSError(-res, os.strerror(-res), file_path)
+                        # Finish short reads (or files that changed size) with plain reads
+                        if res < len(buffer):
+                            del buffer[res:]
+                            while True:
+                                chunk = os.pread(fd, 1 << 20, len(buffer))
+                                if not chunk:
+                                    break
+                                buffer += chunk
+                        os.close(fd)
+                        fd = None
+                        results[index] = (file_path, buffer, None)
+                    except OSError as e:
+                        results[index] = (file_path, None, e)
+                    finally:
+                        if fd is not None:
+                            try:
+                                os.close(fd)
+                            except OSError:
+                                pass
+    except OSError as e:
+        print(f"Warning: io_uring read failed ({e}), reading the remaining files with threads.")
+        _drain_io_uring(lib, ring, cqes, in_flight)
+        remaining = [i for i, result in enumerate(results) if result is None]
+        for index, result in zip(remaining, _read_files_threaded([file_paths[i] for i in remaining])):
+            results[index] = result
+    finally:
+        if in_flight: # E.g. interrupted by Ctrl-C
+            _drain_io_uring(lib, ring, cqes, in_flight)
+        lib.io_uring_queue_exit(ring)
+    return results
+
+def find_script_files(directory, pattern):
+    """Returns the paths of the files in directory whose names match the glob pattern.
+
+    Uses a single os.scandir pass, whose entries already carry the file type, instead of glob.
+    Like glob, hidden files only match patterns that start with a dot.
+    """
+    if os.sep in pattern or (os.altsep and os.altsep in pattern) or glob.has_magic(directory):
+        return glob.glob(os.path.join(directory, pattern)) # Patterns spanning directories
+    match_hidden = pattern.startswith(".")
+    try:
+        with os.scandir(directory) as entries:
+            return [
+                entry.path for entry in entries
+                if (match_hidden or not entry.name.startswith("."))
+                and fnmatch.fnmatch(entry.name, pattern)
+                and entry.is_file()
+            ]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+def load_scripts(directory, pattern, io_backend="threads", sqpoll=False, skipped_files=None):
+    """Loads content from script files matching a pattern in a directory.
+
+    Files are read with a thread pool, or with io_uring when io_backend is "io_uring".
+    If a list is passed as skipped_files, the paths of files that could not be read are added to it.
+    """
     # Use abspath to be sure where we are looking
     absolute_directory = os.path.abspath(directory)
     search_path = os.path.join(absolute_directory, pattern)
-    file_paths = glob.glob(search_path)
+    file_paths = find_script_files(absolute_directory, pattern)
 
     print(f"\nSearching for scripts in: {search_path}")
 
@@ -72,39 +363,208 @@ def load_scripts(directory, pattern):
         return None
 
     print(f"Found {len(file_paths)} script files to process:")
-    for i, file_path in enumerate(sorted(file_paths)):
+    # Collect the raw bytes of every file in one buffer and decode once at the end,
+    # instead of decoding each file and building intermediate strings per file
+    buffer = bytearray()
+    loaded_files = 0
+    sorted_paths = sorted(file_paths)
+    read_results = None
+    if io_backend == "io_uring":
+        read_results = _read_files_io_uring(sorted_paths, sqpoll)
+    if read_results is None:
+        read_results = _read_files_threaded(sorted_paths)
+
+    for file_path, file_bytes, error in read_results:
         filename = os.path.basename(file_path)
         print(f"  - Reading: {filename}")
-        try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                # Add markers to identify source files in the combined content
-                content = f"--- Start of Content from {filename} ---\n\n"
-                content += f.read()
-                content += f"\n\n--- End of Content from {filename} ---"
-                script_contents.append(content)
-        except FileNotFoundError:
-            print(f"Warning: File not found {file_path} during iteration, skipping.") # Should not happen with glob, but for safety
-        except Exception as e:
-            print(f"Error reading file {file_path}: {e}, skipping.")
+        if error is not None:
+            if isinstance(error, FileNotFoundError):
+                print(f"Warning: File not found {file_path} during iteration, skipping.") # Should not happen after scanning, but for safety
+            else:
+                print(f"Error reading file {file_path}: {error}, skipping.")
+            if skipped_files is not None:
+                skipped_files.append(file_path)
+            continue
+
+        # Files are read in binary mode, so normalise each file's line endings the way text
+        # mode would before the markers are added (a trailing bare CR must stay a newline)
+        if b"\r" in file_bytes:
+            file_bytes = file_bytes.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
 
-    if not script_contents:
+        if loaded_files:
+            buffer += b"\n\n"
+        # Add markers to identify source files in the combined content
+        buffer += f"--- Start of Content from {filename} ---\n\n".encode('utf-8')
+        buffer += file_bytes
+        buffer += f"\n\n--- End of Content from {filename} ---".encode('utf-8')
+        loaded_files += 1
+        del file_bytes
+
+    if not loaded_files:
         print("Error: No script content could be loaded successfully.")
         return None
 
-    return "\n\n".join(script_contents)
+    content = buffer.decode('utf-8', errors='ignore')
+    del buffer
+    return content
+
+# --- Function to Load Script Files with an On-Disk Cache ---
+# Part of the cache key; bump it whenever the content produced by load_scripts changes
+SCRIPT_CACHE_FORMAT_VERSION = 2
+def load_scripts_cached(directory, pattern, io_backend="threads", sqpoll=False):
+    """Loads script content like load_scripts, reusing the result of a previous run if no file changed.
+
+    The cache is keyed by the path, modification time, size and inode of every matched file,
+    so editing, adding, removing or atomically replacing a script invalidates it, and by
+    SCRIPT_CACHE_FORMAT_VERSION so content in an outdated format is not reused. Content is only
+    cached when every file could be read, and older cache files are removed when a new one is written.
+    """
+    absolute_directory = os.path.abspath(directory)
+    file_paths = find_script_files(absolute_directory, pattern)
+    if not file_paths:
+        return load_scripts(directory, pattern, io_backend, sqpoll) # Reports the missing files
+
+    try:
+        signature = []
+        for file_path in file_paths:
+            st = os.stat(file_path)
+            signature.append((file_path, st.st_mtime_ns, st.st_size, st.st_ino))
+        signature = (SCRIPT_CACHE_FORMAT_VERSION, tuple(sorted(signature)))
+    except OSError as e:
+        print(f"Warning: Could not stat script files for caching ({e}), loading them directly.")
+        return load_scripts(directory, pattern, io_backend, sqpoll)
+
+    digest = hashlib.blake2b(repr(signature).encode("utf-8"), digest_size=16).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"scripts-{digest}.pkl")
+
+    try:
+        with open(cache_path, "rb") as f:
+            content = pickle.load(f)
+        print(f"\nLoaded {len(file_paths)} unchanged script files from cache: {cache_path}")
+        return content
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Warning: Ignoring unreadable script cache {cache_path}: {e}")
+
+    skipped_files = []
+    content = load_scripts(directory, pattern, io_backend, sqpoll, skipped_files)
+    if skipped_files:
+        # Unreadable files (e.g. wrong permissions) may be fixed without changing the signature
+        print("Warning: Not caching script content because some files could not be read.")
+    elif content:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            # Write to a temporary file first so an interrupted run never leaves a partial cache
+            temp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as f:
+                pickle.dump(content, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, cache_path)
+        except Exception as e:
+            print(f"Warning: Could not write script cache {cache_path}: {e}")
+        else:
+            # Each change to the inputs creates a new cache file, so drop the outdated ones
+            for stale_path in glob.glob(os.path.join(CACHE_DIR, "scripts-*.pkl")):
+                if stale_path != cache_path:
+                    try:
+                        os.remove(stale_path)
+                    except OSError as e:
+                        print(f"Warning: Could not remove old script cache {stale_path}: {e}")
+    return content
 
 # --- Function to Estimate Token Count ---
-# Note: This is a rough estimate. The actual token count might differ.
-def estimate_tokens(text):
-    """Estimates the number of tokens in a text string."""
-    return len(text) / 4 # A common heuristic, not precise
+# Note: This is an estimate. The actual token count might differ slightly.
+TOKEN_SAMPLE_WINDOW_CHARS = 4096
+TOKEN_SAMPLE_MAX_WINDOWS = 64
+
+def estimate_tokens(text, model_name=None):
+    """Estimates the number of tokens in a text string.
+
+    When a model name is given, evenly spaced sample windows (their number growing with the
+    square root of the text size) are counted with the model's tokenizer in a single request,
+    and the measured tokens-per-character ratio is scaled to the whole text. Otherwise, or if
+    counting fails, the common ~4 characters per token heuristic is used.
+    """
+    total_chars = len(text)
+    if model_name is None or total_chars == 0:
+        return int(total_chars / 4) # A common heuristic, not precise
+
+    window_count = min(TOKEN_SAMPLE_MAX_WINDOWS, max(1, math.isqrt(total_chars // TOKEN_SAMPLE_WINDOW_CHARS)))
+    if window_count * TOKEN_SAMPLE_WINDOW_CHARS >= total_chars:
+        sample = text
+    else:
+        last_start = total_chars - TOKEN_SAMPLE_WINDOW_CHARS
+        starts = [i * last_start // max(1, window_count - 1) for i in range(window_count)]
+        sample = "".join(text[start:start + TOKEN_SAMPLE_WINDOW_CHARS] for start in starts)
+
+    try:
+        sampled_tokens = genai.GenerativeModel(model_name).count_tokens(sample).total_tokens
+    except Exception as e:
+        print(f"  - Warning: Could not count tokens with {model_name} ({e}), using a rough estimate.")
+        return int(total_chars / 4)
+    return int(total_chars * sampled_tokens / len(sample))
+
+# --- Functions to Shard Large Inputs (Map Step) ---
+# Each file's content starts with this marker line (see load_scripts)
+SCRIPT_SECTION_PATTERN = re.compile(r"(?=^--- Start of Content from .+ ---$)", re.MULTILINE)
+
+def split_into_shards(content, tokens_per_char, max_tokens_per_shard):
+    """Splits combined script content into shards of at most ~max_tokens_per_shard tokens.
+
+    Shards are cut at file boundaries; a file that is too large on its own is cut at line breaks.
+    """
+    max_chars = max(1, int(max_tokens_per_shard / tokens_per_char))
+    pieces = []
+    for section in SCRIPT_SECTION_PATTERN.split(content):
+        if not section.strip():
+            continue
+        while len(section) > max_chars:
+            cut = section.rfind("\n", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            pieces.append(section[:cut])
+            section = section[cut:]
+        pieces.append(section)
+
+    shards = []
+    current, current_chars = [], 0
+    for piece in pieces:
+        if current and current_chars + len(piece) > max_chars:
+            shards.append("".join(current))
+            current, current_chars = [], 0
+        current.append(piece)
+        current_chars += len(piece)
+    if current:
+        shards.append("".join(current))
+    return shards
+
+async def summarize_shards(shards, map_prompt_template, model_name, generation_config, safety_settings):
+    """Summarizes all shards concurrently and returns their (text, feedback, error) results in order."""
+    # Each prompt embeds a whole shard, so it is passed as a function and only built once the
+    # request can be sent rather than for every shard up front
+    return await asyncio.gather(*(
+        generate_content_async(
+            functools.partial(map_prompt_template.format, script_content=shard),
+            model_name,
+            generation_config,
+            safety_settings,
+            f"Summary of Shard {index}/{len(shards)}"
+        )
+        for index, shard in enumerate(shards, 1)
+    ))
 
 # --- Function to Load Prompt Template ---
+@functools.lru_cache(maxsize=32)
+def _read_prompt_template(filepath, mtime_ns, size):
+    """Reads a prompt template; the modification time and size are part of the cache key only."""
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return f.read()
+
 def load_prompt_template(filepath):
-    """Loads a prompt template from a file."""
+    """Loads a prompt template from a file, reusing the cached text while the file is unchanged."""
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return f.read()
+        st = os.stat(filepath)
+        return _read_prompt_template(filepath, st.st_mtime_ns, st.st_size)
     except FileNotFoundError:
         print(f"Error: Prompt template file not found at {filepath}.")
         sys.exit(1)
@@ -112,17 +572,224 @@ def load_prompt_template(filepath):
         print(f"Error loading prompt template {filepath}: {e}")
         sys.exit(1)
 
-# --- Function to Generate Content using Gemini ---
-def generate_content(prompt, model_name, generation_config, safety_settings, task_description="content"):
-    """Helper function to generate content using Gemini."""
-    print(f"\n[Generating {task_description}...] This may take some time...")
-    model = genai.GenerativeModel(
+# --- Function to Create a Context Cache for the Script Content ---
+def create_context_cache(model_name, content, ttl_seconds):
+    """Uploads content once as a Gemini context cache for the given model.
+
+    Returns the CachedContent, or None if the cache could not be created (e.g. the content is
+    below the model's minimum cacheable size), in which case callers send the content inline.
+    """
+    try:
+        cache = genai.caching.CachedContent.create(
+            model=model_name,
+            display_name="cti-report-scripts",
+            contents=[content],
+            ttl=timedelta(seconds=ttl_seconds)
+        )
+        print(f"  - Context cache {cache.name} created for {model_name} (expires in {ttl_seconds} seconds).")
+        return cache
+    except Exception as e:
+        print(f"  - Warning: Could not create context cache for {model_name}: {e}")
+        print("    The script content will be sent with each prompt instead.")
+        return None
+
+def extend_context_cache(cache, ttl_seconds):
+    """Moves a context cache's expiry to ttl_seconds from now, so long chat sessions can keep using it."""
+    try:
+        cache.update(ttl=timedelta(seconds=ttl_seconds))
+    except Exception as e:
+        print(f"Warning: Could not extend context cache {cache.name}: {e}")
+
+# --- Function to Build a Gemini Model ---
+def build_model(model_name, generation_config, safety_settings, cached_content=None):
+    """Creates a GenerativeModel, bound to a context cache when one is given."""
+    if cached_content is not None:
+        return genai.GenerativeModel.from_cached_content(
+            cached_content=cached_content,
+            generation_config=generation_config,
+            safety_settings=safety_settings
+        )
+    return genai.GenerativeModel(
         model_name=model_name,
         generation_config=generation_config,
         safety_settings=safety_settings
     )
+
+# --- Limiting Concurrent Gemini Requests ---
+# Concurrent requests can exceed the requests/tokens per minute quota, so cap how many are
+# in flight at once. A semaphore belongs to one event loop, so one is kept per running loop.
+GEMINI_MAX_INFLIGHT = config.get('concurrency', {}).get('max_inflight', 5)
+_GEMINI_SEMAPHORES = weakref.WeakKeyDictionary()
+
+def _gemini_semaphore():
+    """Returns the semaphore limiting concurrent Gemini requests on the running event loop."""
+    loop = asyncio.get_running_loop()
+    semaphore = _GEMINI_SEMAPHORES.get(loop)
+    if semaphore is None:
+        semaphore = _GEMINI_SEMAPHORES[loop] = asyncio.Semaphore(GEMINI_MAX_INFLIGHT)
+    return semaphore
+
+# --- Retrying Transient Gemini Errors ---
+# Rate limiting (429) and temporary server errors (5xx) usually succeed on a later attempt,
+# so retry those instead of failing the report part: after the delay the API asks for when it
+# gives one, otherwise with exponential backoff and jitter.
+RETRYABLE_GEMINI_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+)
+GEMINI_MAX_ATTEMPTS = 6
+
+def _log_retry(retry_state):
+    """Reports a failed Gemini request that is about to be retried."""
+    print(f"  - Gemini request failed ({retry_state.outcome.exception()}), "
+          f"retrying in {retry_state.next_action.sleep:.1f} seconds "
+          f"(attempt {retry_state.attempt_number}/{GEMINI_MAX_ATTEMPTS})...")
+
+GEMINI_MAX_RETRY_DELAY_SECONDS = 120
+_backoff_wait = tenacity.wait_exponential_jitter(initial=1, max=30)
+
+def _server_retry_delay(exception):
+    """Returns the delay in seconds the API asked for before retrying, or None if it gave none.
+
+    Rate-limit errors carry it as a google.rpc.RetryInfo detail (a proto over gRPC, a dict over
+    REST); plain HTTP errors may carry a Retry-After header instead.
+    """
+    for detail in getattr(exception, "details", None) or []:
+        if isinstance(detail, dict):
+            delay = detail.get("retryDelay") or detail.get("retry_delay")
+            if isinstance(delay, str) and delay.endswith("s"):
+                try:
+                    return float(delay[:-1])
+                except ValueError:
+                    pass
+        else:
+            delay = getattr(detail, "retry_delay", None)
+            if delay is not None:
+                return delay.seconds + delay.nanos / 1e9
+    response = getattr(exception, "response", None)
+    retry_after = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return None
+
+def _retry_wait(retry_state):
+    """Waits as long as the API asked for, or backs off exponentially with jitter otherwise."""
+    delay = _server_retry_delay(retry_state.outcome.exception())
+    if delay is not None:
+        return min(delay, GEMINI_MAX_RETRY_DELAY_SECONDS)
+    return _backoff_wait(retry_state)
+
+gemini_retry = tenacity.retry(
+    retry=tenacity.retry_if_exception_type(RETRYABLE_GEMINI_ERRORS),
+    wait=_retry_wait,
+    stop=tenacity.stop_after_attempt(GEMINI_MAX_ATTEMPTS),
+    before_sleep=_log_retry,
+    reraise=True
+)
+
+@gemini_retry
+def _send_request(model, prompt, stream=False):
+    """Sends a generation request; for streams, the first chunk is received before returning."""
+    return model.generate_content(prompt, stream=stream)
+
+@gemini_retry
+async def _send_request_async(model, prompt, stream=False):
+    """Async counterpart of _send_request."""
+    return await model.generate_content_async(prompt, stream=stream)
+
+# --- Function to Generate Content using Gemini ---
+class _EmptyResponseError(ValueError):
+    """Raised while streaming a response that has no text, e.g. because the prompt was blocked."""
+    def __init__(self, feedback):
+        super().__init__(f"Empty response or safety block: {feedback}")
+        self.feedback = feedback
+
+def _chunk_text(chunk):
+    """Returns the text of a streamed response chunk ("" if it only carries the finish reason).
+
+    Raises _EmptyResponseError if the prompt was blocked, and the SDK's ValueError if the
+    response was stopped for another reason (e.g. a safety block of the answer itself).
+    """
+    if not chunk.candidates:
+        raise _EmptyResponseError(chunk.prompt_feedback)
+    candidate = chunk.candidates[0]
+    if not candidate.content.parts and candidate.finish_reason == genai.protos.Candidate.FinishReason.STOP:
+        return ""
+    return chunk.text
+
+def _stream_text(response):
+    """Yields the text of each chunk of a streamed response."""
+    received_text = False
+    try:
+        for chunk in response:
+            text = _chunk_text(chunk)
+            if text:
+                received_text = True
+                yield text
+    except genai.types.BlockedPromptException:
+        raise _EmptyResponseError(response.prompt_feedback) from None
+    if not received_text:
+        raise _EmptyResponseError(response.prompt_feedback)
+
+def generate_content(prompt, model_name, generation_config, safety_settings, task_description="content", cached_content=None, stream=False):
+    """Helper function to generate content using Gemini.
+
+    With stream=True the text is returned as a generator of chunks as they arrive instead of a
+    single string; errors that occur mid-response (e.g. safety blocks) are raised while iterating.
+    """
+    print(f"\n[Generating {task_description}...] This may take some time...")
+    model = build_model(model_name, generation_config, safety_settings, cached_content)
+    try:
+        if stream:
+            return _stream_text(_send_request(model, prompt, stream=True)), None, None
+        response = _send_request(model, prompt)
+        # Check for empty response or safety blocks
+        if response is None or not response.text:
+             feedback = response.prompt_feedback if response else "No response object"
+             return None, feedback, f"Empty response or safety block: {feedback}"
+        return response.text, response.prompt_feedback, None
+    except Exception as e:
+        return None, None, f"Error generating {task_description}: {e}"
+
+# --- Function to Generate Content using Gemini (async) ---
+async def _stream_text_async(model, prompt, semaphore):
+    """Yields the text of each chunk of a streamed response, holding the semaphore until it ends."""
+    async with semaphore:
+        response = await _send_request_async(model, prompt() if callable(prompt) else prompt, stream=True)
+        received_text = False
+        try:
+            async for chunk in response:
+                text = _chunk_text(chunk)
+                if text:
+                    received_text = True
+                    yield text
+        except genai.types.BlockedPromptException:
+            raise _EmptyResponseError(response.prompt_feedback) from None
+        if not received_text:
+            raise _EmptyResponseError(response.prompt_feedback)
+
+async def generate_content_async(prompt, model_name, generation_config, safety_settings, task_description="content", semaphore=None, cached_content=None, stream=False):
+    """Helper coroutine to generate content using Gemini without blocking the event loop.
+
+    Requests wait on the shared Gemini semaphore (or the given asyncio.Semaphore) so that no
+    more than the configured number are in flight at once. The prompt may also be given as a
+    function returning it, which is only called once the request holds the semaphore.
+    With stream=True the text is returned as an async generator of chunks, like generate_content.
+    """
+    print(f"\n[Generating {task_description}...] This may take some time...")
+    model = build_model(model_name, generation_config, safety_settings, cached_content)
+    if semaphore is None:
+        semaphore = _gemini_semaphore()
+    if stream:
+        return _stream_text_async(model, prompt, semaphore), None, None
     try:
-        response = model.generate_content(prompt)
+        async with semaphore:
+            response = await _send_request_async(model, prompt() if callable(prompt) else prompt)
         # Check for empty response or safety blocks
         if response is None or not response.text:
              feedback = response.prompt_feedback if response else "No response object"
@@ -131,17 +798,399 @@ def generate_content(prompt, model_name, generation_config, safety_settings, tas
     except Exception as e:
         return None, None, f"Error generating {task_description}: {e}"
 
+# --- Function to Generate Content using the Gemini Batch API ---
+BATCH_FINISHED_STATES = ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED")
+
+def _parse_batch_response(response):
+    """Extracts (text, feedback, error) from a GenerateContentResponse returned by a batch job."""
+    feedback = response.get("promptFeedback") or response.get("prompt_feedback")
+    candidates = response.get("candidates") or []
+    parts = candidates[0].get("content", {}).get("parts", []) if candidates else []
+    text = "".join(part.get("text", "") for part in parts)
+    if not text:
+        return None, feedback, f"Empty response or safety block: {feedback}"
+    return text, feedback, None
+
+def generate_content_batch(requests, script_content, poll_interval_seconds):
+    """Generates content for several prompts through the Gemini Batch API.
+
+    `requests` is a list of (custom_id, prompt_template, model_name, generation_config,
+    safety_settings) tuples; each template is filled with script_content only while its record
+    is written, so a single full prompt is in memory at a time. One batch job is submitted per
+    model, each as an uploaded JSONL file; the jobs are polled until they finish and the results
+    are returned as a dict mapping each custom_id to a (text, feedback, error) tuple, like
+    generate_content.
+    """
+    try:
+        from google import genai as genai_client # Only required for batch mode
+    except ImportError:
+        print("Error: Batch mode requires the 'google-genai' package (1.22.0 or later). Install it with 'pip install -U google-genai'.")
+        sys.exit(1)
+
+    client = genai_client.Client(api_key=api_key)
+    results = {}
+
+    # A batch job targets a single model, so group the requests by model
+    requests_by_model = {}
+    for request in requests:
+        requests_by_model.setdefault(request[2], []).append(request)
+
+    # Submit every job first so they are processed side by side, then poll them
+    pending_jobs = {}
+    for model_name, model_requests in requests_by_model.items():
+        custom_ids = [request[0] for request in model_requests]
+        jsonl_path = None
+        try:
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".jsonl", delete=False) as f:
+                jsonl_path = f.name
+                for custom_id, prompt_template, _, generation_config, safety_settings in model_requests:
+                    record = {
+                        "key": custom_id,
+                        "request": {
+                            "contents": [{"role": "user", "parts": [{"text": prompt_template.format(script_content=script_content)}]}],
+                            "generationConfig": generation_config,
+                            "safetySettings": safety_settings,
+                        },
+                    }
+                    f.write(json.dumps(record))
+                    f.write("\n")
+            uploaded_file = client.files.upload(
+                file=jsonl_path,
+                config={"display_name": "cti-report-batch-requests", "mime_type": "jsonl"}
+            )
+            job = client.batches.create(
+                model=model_name,
+                src=uploaded_file.name,
+                config={"display_name": "cti-report-batch"}
+            )
+            print(f"  - Submitted batch job {job.name} for {', '.join(custom_ids)} ({model_name})")
+            pending_jobs[job.name] = (job, custom_ids)
+        except Exception as e:
+            for custom_id in custom_ids:
+                results[custom_id] = (None, None, f"Error submitting batch job for {custom_id}: {e}")
+        finally:
+            if jsonl_path and os.path.exists(jsonl_path):
+                os.remove(jsonl_path)
+
+    while pending_jobs:
+        print(f"\nWaiting {poll_interval_seconds} seconds for {len(pending_jobs)} batch job(s) to finish...")
+        time.sleep(poll_interval_seconds)
+        for job_name, (job, custom_ids) in list(pending_jobs.items()):
+            try:
+                job = client.batches.get(name=job_name)
+            except Exception as e:
+                print(f"  - Warning: Could not poll batch job {job_name}: {e}")
+                continue
+            state = job.state.name
+            print(f"  - Batch job {job_name}: {state}")
+            if state not in BATCH_FINISHED_STATES:
+                continue
+            del pending_jobs[job_name]
+
+            # Partially succeeded jobs still have a results file; failed requests carry an error there
+            if state not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+                for custom_id in custom_ids:
+                    results[custom_id] = (None, None, f"Batch job {job_name} ended in state {state}: {job.error}")
+                continue
+            try:
+                result_lines = client.files.download(file=job.dest.file_name).decode("utf-8").splitlines()
+                # Demultiplex the results back to their requests by key
+                for line in result_lines:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    custom_id = record.get("key")
+                    if "error" in record:
+                        results[custom_id] = (None, None, f"Error generating {custom_id}: {record['error']}")
+                    else:
+                        results[custom_id] = _parse_batch_response(record.get("response", {}))
+            except Exception as e:
+                for custom_id in custom_ids:
+                    results[custom_id] = (None, None, f"Error retrieving batch results for {custom_id}: {e}")
+
+    for custom_id, *_ in requests:
+        results.setdefault(custom_id, (None, None, f"No result returned for {custom_id}"))
+    return results
+
+# --- Functions to Save Generated Content ---
+def _report_part_header(part_label, generated_on):
+    """Returns the markdown title block written at the top of a report part."""
+    return (
+        f"# XCSSET Malware 2025: Updated Techniques and Payloads ({part_label})\n\n"
+        f"Generated on: {generated_on}\n"
+        "---\n\n"
+    )
+
+def save_report_part(report_text, feedback, error, output_filename, part_label, generated_on):
+    """Saves a generated report part as markdown, or reports why its generation failed."""
+    if report_text:
+        print(f"\n--- Generated CTI Report ({part_label}) ---")
+        # print(report_text) # Optionally print to console
+        try:
+            with open(output_filename, "w", encoding="utf-8") as f:
+                f.write(f"{_report_part_header(part_label, generated_on)}{report_text}")
+            print(f"\nReport {part_label} successfully saved to: {output_filename}")
+        except Exception as e:
+            print(f"\nError saving Report {part_label}: {e}")
+    else:
+        print(f"\n--- Report {part_label} Generation Failed ---")
+        if error:
+            print(f"Error: {error}")
+        if feedback:
+            print(f"Prompt Feedback ({part_label}): {feedback}")
+            # Potentially print safety ratings for debugging
+            # print(f"Safety Ratings ({part_label}): {feedback.safety_ratings}")
+
+def _finish_report_stream(error, received_text, temp_filename, output_filename, part_label, generated_on):
+    """Moves a completely streamed report part into place, or reports why streaming failed.
+
+    On failure the previous report is left untouched; any partial output stays in temp_filename.
+    """
+    if error is None:
+        try:
+            os.replace(temp_filename, output_filename)
+            print(f"\n--- Generated CTI Report ({part_label}) ---")
+            print(f"\nReport {part_label} successfully saved to: {output_filename}")
+        except OSError as e:
+            print(f"\nError saving Report {part_label}: {e}")
+        return
+
+    if isinstance(error, _EmptyResponseError):
+        save_report_part(None, error.feedback, str(error), output_filename, part_label, generated_on)
+    else:
+        save_report_part(None, None, f"Error streaming CTI Report {part_label}: {error}", output_filename, part_label, generated_on)
+    if received_text:
+        print(f"Partial output was kept in: {temp_filename}")
+    else:
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+
+def save_report_part_stream(report_chunks, feedback, error, output_filename, part_label, generated_on):
+    """Writes a report part to disk chunk by chunk while it is being generated.
+
+    The chunks are written to output_filename + ".tmp", which only replaces the report once the
+    whole part has arrived, so a failed generation never overwrites a previous report.
+    """
+    if report_chunks is None:
+        save_report_part(None, feedback, error, output_filename, part_label, generated_on)
+        return
+    temp_filename = output_filename + ".tmp"
+    received_text = False
+    stream_error = None
+    try:
+        with open(temp_filename, "w", encoding="utf-8") as f:
+            f.write(_report_part_header(part_label, generated_on))
+            for chunk_text in report_chunks:
+                f.write(chunk_text)
+                f.flush()
+                received_text = True
+    except Exception as e:
+        stream_error = e
+    _finish_report_stream(stream_error, received_text, temp_filename, output_filename, part_label, generated_on)
+
+async def save_report_part_stream_async(report_chunks, feedback, error, output_filename, part_label, generated_on):
+    """Async counterpart of save_report_part_stream for chunks from generate_content_async."""
+    if report_chunks is None:
+        save_report_part(None, feedback, error, output_filename, part_label, generated_on)
+        return
+    temp_filename = output_filename + ".tmp"
+    received_text = False
+    stream_error = None
+    try:
+        with open(temp_filename, "w", encoding="utf-8") as f:
+            f.write(_report_part_header(part_label, generated_on))
+            async for chunk_text in report_chunks:
+                f.write(chunk_text)
+                f.flush()
+                received_text = True
+    except Exception as e:
+        stream_error = e
+    _finish_report_stream(stream_error, received_text, temp_filename, output_filename, part_label, generated_on)
+
+# Matches the model's response with an optional surrounding ``` / ```mermaid fence and
+# captures the diagram body without the fence or surrounding whitespace
+MERMAID_FENCE_PATTERN = re.compile(r"^\s*(?:```(?:mermaid)?)?\s*(.*?)\s*(?:```)?\s*$", re.DOTALL)
+
+def save_mermaid_diagram(mermaid_syntax, feedback, error, mermaid_filename, generated_on):
+    """Saves the generated Mermaid syntax in a markdown code block, or reports why it failed."""
+    if mermaid_syntax:
+        print("\n--- Generated Mermaid Diagram ---")
+        # print(mermaid_syntax) # Optionally print to console
+        try:
+            # Clean up potential markdown block from the model's response
+            mermaid_syntax = MERMAID_FENCE_PATTERN.match(mermaid_syntax).group(1)
+            with open(mermaid_filename, "w", encoding="utf-8") as f:
+                f.write(
+                    f"# XCSSET Malware 2025: Relationship Diagram\n\n"
+                    f"Generated on: {generated_on}\n"
+                    "---\n\n"
+                    f"```mermaid\n{mermaid_syntax}\n```"
+                )
+            print(f"\nMermaid diagram syntax saved to: {mermaid_filename}")
+        except Exception as e:
+            print(f"\nError saving Mermaid diagram: {e}")
+    else:
+        print("\n--- Mermaid Diagram Generation Failed ---")
+        if error:
+            print(f"Error: {error}")
+        if feedback:
+            print(f"Prompt Feedback (Mermaid): {feedback}")
+            # Potentially print safety ratings for debugging
+            # print(f"Safety Ratings (Mermaid): {feedback.safety_ratings}")
+
+
+# --- Functions to Persist the Chat Session ---
+CHAT_HISTORY_FILE = os.path.join(CACHE_DIR, "chat-history.pkl")
+
+def load_chat_history(history_file, ttl_seconds):
+    """Returns the chat history saved by a previous run, or an empty list if none is recent enough."""
+    try:
+        if time.time() - os.path.getmtime(history_file) > ttl_seconds:
+            print("Previous chat session has expired, starting a new one.")
+            return []
+        with open(history_file, "rb") as f:
+            history = pickle.load(f)
+        # Sessions saved by earlier versions may hold messages without parts, which the API rejects
+        history = [message for message in history if message.get("parts")]
+        print(f"Restored {len(history)} messages from the previous chat session.")
+        return history
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        print(f"Warning: Could not restore chat history from {history_file}: {e}")
+        return []
+
+def save_chat_history(history, history_file):
+    """Saves a chat history as plain role/parts dictionaries that start_chat accepts.
+
+    Only text parts are kept; messages without any (e.g. an empty MAX_TOKENS answer) are left
+    out, since the API rejects messages with empty parts.
+    """
+    messages = []
+    for content in history:
+        parts = [part.text for part in content.parts if part.text]
+        if parts:
+            messages.append({"role": content.role, "parts": parts})
+    try:
+        os.makedirs(os.path.dirname(history_file), exist_ok=True)
+        temp_file = f"{history_file}.{os.getpid()}.tmp"
+        with open(temp_file, "wb") as f:
+            pickle.dump(messages, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, history_file)
+    except Exception as e:
+        print(f"Warning: Could not save chat history to {history_file}: {e}")
+
+# --- Chat Interface ---
+def _stream_chat_answer(chat, user_input, before_message=None):
+    """Sends a chat message and prints the answer as it streams in (runs in a worker thread)."""
+    if before_message is not None:
+        before_message()
+    response = chat.send_message(user_input, stream=True)
+    print("Gemini > ", end="", flush=True)
+    for chunk in response:
+        text = _chunk_text(chunk) # The final chunk may only carry the finish reason
+        if text:
+            print(text, end="", flush=True)
+    print()
+    return list(chat.history)
+
+async def send_chat_message(chat, user_input, persist_history, background_tasks, before_message=None):
+    """Streams Gemini's answer to one message, then saves the history without blocking the chat."""
+    try:
+        history = await asyncio.to_thread(_stream_chat_answer, chat, user_input, before_message)
+    except Exception as e:
+        print(f"\nError during chat interaction: {e}")
+        # A broken streamed answer is left pending in chat.last; drop it so the session stays
+        # usable. If the request failed before any response, there is nothing to drop, and
+        # rewind() would remove the previous, successful exchange instead.
+        if chat.last is not None:
+            try:
+                chat.rewind()
+            except Exception:
+                pass
+        return
+    if persist_history:
+        # Saves share one temporary file and must land in order, so only one runs at a time
+        if background_tasks:
+            await asyncio.gather(*background_tasks)
+        task = asyncio.create_task(asyncio.to_thread(save_chat_history, history, CHAT_HISTORY_FILE))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+async def chat_loop(chat, persist_history, before_message=None):
+    """Runs the chat prompt. The next question can be typed while the previous answer streams in;
+    it is sent once that answer is complete, since a chat session handles one message at a time.
+    before_message, if given, is called in the worker thread before each message is sent."""
+    session = PromptSession()
+    pending_message = None
+    background_tasks = set()
+    with patch_stdout():
+        while True:
+            try:
+                user_input = await session.prompt_async("\nAsk Gemini > ")
+            except (EOFError, KeyboardInterrupt):
+                break
+            if user_input.lower() in ['exit', 'quit']:
+                break
+            if not user_input.strip():
+                continue
+
+            if pending_message is not None:
+                await pending_message
+            pending_message = asyncio.create_task(
+                send_chat_message(chat, user_input, persist_history, background_tasks, before_message)
+            )
+
+        if pending_message is not None:
+            await pending_message
+        if background_tasks:
+            await asyncio.gather(*background_tasks)
+
+# --- Event Loop ---
+def close_event_loop(loop):
+    """Cancels any tasks left on the loop and closes it, like asyncio.run does when it returns."""
+    try:
+        pending = asyncio.all_tasks(loop)
+        if pending:
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.run_until_complete(loop.shutdown_default_executor())
+    finally:
+        loop.close()
+
 
 # --- Main Execution ---
 if __name__ == "__main__":
     print("--- Automated CTI Report Generator using Gemini ---")
+    # Shared "Generated on" timestamp for all files written by this run
+    report_timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
     # --- Configuration Values ---
+    generation_mode = config.get('mode', 'interactive')
+    if generation_mode not in GENERATION_MODES:
+        print(f"Error: Unknown mode '{generation_mode}' in {CONFIG_FILE}. Expected one of: {', '.join(GENERATION_MODES)}.")
+        sys.exit(1)
     input_directory = config['input']['directory']
     script_file_pattern = config['input']['file_pattern']
+    cache_scripts = config['input'].get('cache', True)
+    io_backend = config.get('io', {}).get('backend', 'threads')
+    io_sqpoll = config.get('io', {}).get('sqpoll', False)
+    if io_backend not in IO_BACKENDS:
+        print(f"Error: Unknown io.backend '{io_backend}' in {CONFIG_FILE}. Expected one of: {', '.join(IO_BACKENDS)}.")
+        sys.exit(1)
     output_directory = config['output']['directory']
     output_base_filename = config['output']['base_filename']
-    report_interval_seconds = config['report_settings']['interval_seconds']
+    stream_reports = config.get('report_settings', {}).get('stream', True)
+    batch_poll_interval_seconds = config.get('batch', {}).get('poll_interval_seconds', 30)
+
+    context_cache_config = config.get('context_cache', {})
+    context_cache_enabled = context_cache_config.get('enabled', True)
+    context_cache_ttl_seconds = context_cache_config.get('ttl_seconds', 3600)
+    context_cache_min_tokens = context_cache_config.get('min_input_tokens', 4096)
 
     report_model = config['models']['report_model']
     other_model = config['models']['other_model']
@@ -153,7 +1202,19 @@ if __name__ == "__main__":
     part1_prompt_file = config['prompts']['part1_file']
     part2_prompt_file = config['prompts']['part2_file']
     mermaid_prompt_file = config['prompts']['mermaid_file']
+    map_prompt_file = config['prompts'].get('map_file', 'prompts/map_prompt.txt')
+
+    chat_config = config.get('chat', {})
+    persist_chat_history = chat_config.get('persist_history', True)
+    chat_history_ttl_seconds = chat_config.get('history_ttl_seconds', 86400)
 
+    sharding_config = config.get('sharding', {})
+    sharding_enabled = sharding_config.get('enabled', True)
+    max_tokens_per_shard = sharding_config.get('max_tokens_per_shard', 200000)
+
+    output_filename_part_1 = os.path.join(output_directory, f"{output_base_filename}_part1.md")
+    output_filename_part_2 = os.path.join(output_directory, f"{output_base_filename}_part2.md")
+    mermaid_filename = os.path.join(output_directory, f"{output_base_filename}_diagram.md")
 
     # --- Ensure Output Directory Exists ---
     try:
@@ -165,7 +1226,10 @@ if __name__ == "__main__":
 
     # --- Load Data and Prompts ---
     print("\n[Step 1/5] Loading input script data...")
-    all_scripts_content = load_scripts(input_directory, script_file_pattern)
+    if cache_scripts:
+        all_scripts_content = load_scripts_cached(input_directory, script_file_pattern, io_backend, io_sqpoll)
+    else:
+        all_scripts_content = load_scripts(input_directory, script_file_pattern, io_backend, io_sqpoll)
 
     if not all_scripts_content:
         print("\nCritical Error: Failed to load input scripts. Exiting.")
@@ -178,169 +1242,226 @@ if __name__ == "__main__":
 
     # --- Estimate Input Size ---
     print(f"\nEstimating combined input size...")
-    estimated_input_tokens = estimate_tokens(all_scripts_content)
-    print(f"  - Estimated input tokens: ~{estimated_input_tokens:.0f}")
-
-    # --- Prepare Prompts with Data ---
-    final_prompt_part_1 = part1_prompt_template.format(script_content=all_scripts_content)
-    final_prompt_part_2 = part2_prompt_template.format(script_content=all_scripts_content)
-    final_prompt_mermaid = mermaid_prompt_template.format(script_content=all_scripts_content)
-
-
-    # --- Generate Report Part 1 ---
-    print("\n[Step 3/5] Starting Report Part 1 generation...")
-    report_part_1, feedback_part_1, error_part_1 = generate_content(
-        final_prompt_part_1,
-        report_model,
-        report_generation_config,
-        safety_settings_config,
-        "CTI Report Part 1"
-    )
+    estimated_input_tokens = estimate_tokens(all_scripts_content, report_model)
+    print(f"  - Estimated input tokens: ~{estimated_input_tokens}")
 
-    if report_part_1:
-        print("\n--- Generated CTI Report (Part 1) ---")
-        # print(report_part_1) # Optionally print to console
-        # Save Part 1
-        output_filename_part_1 = os.path.join(output_directory, f"{output_base_filename}_part1.md")
-        try:
-            with open(output_filename_part_1, "w", encoding="utf-8") as f:
-                f.write(f"# XCSSET Malware 2025: Updated Techniques and Payloads (Part 1)\n\n")
-                f.write(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                f.write("---\n\n")
-                f.write(report_part_1)
-            print(f"\nReport Part 1 successfully saved to: {output_filename_part_1}")
-        except Exception as e:
-            print(f"\nError saving Report Part 1: {e}")
-    else:
-        print("\n--- Report Part 1 Generation Failed ---")
-        if error_part_1:
-            print(f"Error: {error_part_1}")
-        if feedback_part_1:
-            print(f"Prompt Feedback (Part 1): {feedback_part_1}")
-            # Potentially print safety ratings for debugging
-            # print(f"Safety Ratings (Part 1): {feedback_part_1.safety_ratings}")
+    # All async work runs on this one event loop: the SDK creates its async client once per
+    # process, and the client stays bound to the loop it was first used on.
+    event_loop = asyncio.new_event_loop()
+    context_caches = {}
+    try:
+        # --- Summarize Oversized Input in Shards (Map Step) ---
+        # Inputs too large for a single prompt are split into shards that are summarized
+        # concurrently. The combined summaries then take the place of the raw scripts in the
+        # report and diagram prompts, which act as the reduce step.
+        if sharding_enabled and estimated_input_tokens > max_tokens_per_shard:
+            shards = split_into_shards(
+                all_scripts_content,
+                estimated_input_tokens / len(all_scripts_content),
+                max_tokens_per_shard
+            )
+            print(f"\nInput exceeds {max_tokens_per_shard} tokens, summarizing it in {len(shards)} shards...")
+            map_prompt_template = load_prompt_template(map_prompt_file)
+            shard_results = event_loop.run_until_complete(summarize_shards(
+                shards,
+                map_prompt_template,
+                report_model,
+                report_generation_config,
+                safety_settings_config
+            ))
+            del shards
 
+            shard_summaries = []
+            for index, (summary, feedback, error) in enumerate(shard_results, 1):
+                if not summary:
+                    print(f"\nCritical Error: Failed to summarize shard {index}/{len(shard_results)}: {error or feedback}")
+                    print("The report would be missing part of the input. Exiting.")
+                    sys.exit(1)
+                shard_summaries.append(
+                    f"--- Start of Summary of Shard {index}/{len(shard_results)} ---\n\n"
+                    f"{summary}\n\n"
+                    f"--- End of Summary of Shard {index}/{len(shard_results)} ---"
+                )
+            all_scripts_content = "\n\n".join(shard_summaries)
+            del shard_results, shard_summaries
+            estimated_input_tokens = estimate_tokens(all_scripts_content, report_model)
+            print(f"  - Estimated tokens after summarization: ~{estimated_input_tokens}")
 
-    print(f"\nWaiting for {report_interval_seconds} seconds before generating Part 2...")
-    time.sleep(report_interval_seconds)
+        # --- Upload Script Content Once as a Context Cache ---
+        # Every prompt embeds the same script content. Caching it lets each request carry only its
+        # own instructions while Gemini reuses the already processed content. Batch jobs may start
+        # long after the cache has expired, so batch mode always sends the content inline.
+        if context_cache_enabled and generation_mode != "batch":
+            if estimated_input_tokens < context_cache_min_tokens:
+                print(f"\nSkipping context caching: input is below {context_cache_min_tokens} tokens.")
+            else:
+                print("\nCreating context cache for the script content...")
+                # Caches are tied to a model, so create one per distinct model
+                for model_name in dict.fromkeys((report_model, other_model)):
+                    cache = create_context_cache(model_name, all_scripts_content, context_cache_ttl_seconds)
+                    if cache:
+                        context_caches[model_name] = cache
+        report_cache = context_caches.get(report_model)
+        other_cache = context_caches.get(other_model)
 
-    # --- Generate Report Part 2 ---
-    print(f"\n[Step 4/5] Starting Report Part 2 generation...")
-    report_part_2, feedback_part_2, error_part_2 = generate_content(
-        final_prompt_part_2,
-        report_model,
-        report_generation_config,
-        safety_settings_config,
-        "CTI Report Part 2"
-    )
+        # --- Prepare Prompts with Data ---
+        # Each prompt embeds the full script content unless it is cached, so prompts are built only
+        # when their request is sent instead of keeping all three alive for the rest of the run.
+        def build_prompt(prompt_template, cache):
+            """Fills a prompt template with the script content, or a note pointing to the cache."""
+            return prompt_template.format(script_content=CACHED_SCRIPT_CONTENT_NOTE if cache else all_scripts_content)
 
-    if report_part_2:
-        print("\n--- Generated CTI Report (Part 2) ---")
-         # print(report_part_2) # Optionally print to console
-        # Save Part 2
-        output_filename_part_2 = os.path.join(output_directory, f"{output_base_filename}_part2.md")
-        try:
-            with open(output_filename_part_2, "w", encoding="utf-8") as f:
-                f.write(f"# XCSSET Malware 2025: Updated Techniques and Payloads (Part 2)\n\n")
-                f.write(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                f.write("---\n\n")
-                f.write(report_part_2)
-            print(f"\nReport Part 2 successfully saved to: {output_filename_part_2}")
-        except Exception as e:
-            print(f"\nError saving Report Part 2: {e}")
-    else:
-        print("\n--- Report Part 2 Generation Failed ---")
-        if error_part_2:
-            print(f"Error: {error_part_2}")
-        if feedback_part_2:
-            print(f"Prompt Feedback (Part 2): {feedback_part_2}")
-             # Potentially print safety ratings for debugging
-            # print(f"Safety Ratings (Part 2): {feedback_part_2.safety_ratings}")
-
-    # --- Generate Mermaid Diagram ---
-    print(f"\n[Step 5/5] Starting Mermaid Diagram generation...")
-    mermaid_syntax, feedback_mermaid, error_mermaid = generate_content(
-        final_prompt_mermaid,
-        other_model,
-        other_generation_config,
-        safety_settings_config,
-        "Mermaid Diagram"
-    )
 
-    if mermaid_syntax:
-        print("\n--- Generated Mermaid Diagram ---")
-        # print(mermaid_syntax) # Optionally print to console
-        # Save Mermaid syntax to a file
-        mermaid_filename = os.path.join(output_directory, f"{output_base_filename}_diagram.md")
-        try:
-            with open(mermaid_filename, "w", encoding="utf-8") as f:
-                f.write(f"# XCSSET Malware 2025: Relationship Diagram\n\n")
-                f.write(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                f.write("---\n\n")
-                f.write("```mermaid\n")
-                # Clean up potential markdown block from the model's response
-                mermaid_syntax = mermaid_syntax.strip()
-                if mermaid_syntax.startswith("```mermaid"):
-                     mermaid_syntax = mermaid_syntax[len("```mermaid"):].strip()
-                if mermaid_syntax.endswith("```"):
-                     mermaid_syntax = mermaid_syntax[:-len("```")].strip()
-
-                f.write(mermaid_syntax)
-                f.write("\n```")
-            print(f"\nMermaid diagram syntax saved to: {mermaid_filename}")
-        except Exception as e:
-            print(f"\nError saving Mermaid diagram: {e}")
-    else:
-        print("\n--- Mermaid Diagram Generation Failed ---")
-        if error_mermaid:
-            print(f"Error: {error_mermaid}")
-        if feedback_mermaid:
-            print(f"Prompt Feedback (Mermaid): {feedback_mermaid}")
-            # Potentially print safety ratings for debugging
-            # print(f"Safety Ratings (Mermaid): {feedback_mermaid.safety_ratings}")
+        if generation_mode == "legacy":
+            # --- Generate Report Part 1 ---
+            print("\n[Step 3/5] Starting Report Part 1 generation...")
+            part_1_result = generate_content(
+                build_prompt(part1_prompt_template, report_cache),
+                report_model,
+                report_generation_config,
+                safety_settings_config,
+                "CTI Report Part 1",
+                cached_content=report_cache,
+                stream=stream_reports
+            )
+            if stream_reports:
+                save_report_part_stream(*part_1_result, output_filename_part_1, "Part 1", report_timestamp)
+            else:
+                save_report_part(*part_1_result, output_filename_part_1, "Part 1", report_timestamp)
 
+            # No fixed pause before Part 2: rate limits are handled by retrying with the delay the
+            # API asks for (see gemini_retry)
+            # --- Generate Report Part 2 ---
+            print(f"\n[Step 4/5] Starting Report Part 2 generation...")
+            part_2_result = generate_content(
+                build_prompt(part2_prompt_template, report_cache),
+                report_model,
+                report_generation_config,
+                safety_settings_config,
+                "CTI Report Part 2",
+                cached_content=report_cache,
+                stream=stream_reports
+            )
+            if stream_reports:
+                save_report_part_stream(*part_2_result, output_filename_part_2, "Part 2", report_timestamp)
+            else:
+                save_report_part(*part_2_result, output_filename_part_2, "Part 2", report_timestamp)
 
-    # --- Chat System ---
-    print("\n--- Starting Chat System ---")
-    print("You can now ask questions about the malware scripts and generated report content.")
-    print("Type 'exit' or 'quit' to end the chat.")
+            # --- Generate Mermaid Diagram ---
+            print(f"\n[Step 5/5] Starting Mermaid Diagram generation...")
+            mermaid_syntax, feedback_mermaid, error_mermaid = generate_content(
+                build_prompt(mermaid_prompt_template, other_cache),
+                other_model,
+                other_generation_config,
+                safety_settings_config,
+                "Mermaid Diagram",
+                cached_content=other_cache
+            )
+            save_mermaid_diagram(mermaid_syntax, feedback_mermaid, error_mermaid, mermaid_filename, report_timestamp)
 
-    # Start a new chat session
-    # You might want to initialize the chat with some context, e.g., the combined script content
-    # chat = chat_model.start_chat(history=[{'role': 'user', 'parts': [all_scripts_content]}])
-    # For simplicity, let's start a fresh chat, relying on the model's general knowledge
-    # or the ability to reference recent context depending on the model version.
-    # Using the 'other_model' for chat as it might be configured differently from the report model
-    try:
-        chat_model = genai.GenerativeModel(
-             model_name=other_model,
-             generation_config=other_generation_config,
-             safety_settings=safety_settings_config
-        )
-        chat = chat_model.start_chat() # Start a blank chat history
-        print("Chat session started.")
-    except Exception as e:
-         print(f"\nError initializing chat model: {e}")
-         chat = None # Disable chat if initialization fails
+        else:
+            if generation_mode == "batch":
+                # --- Generate Everything through the Gemini Batch API ---
+                # Cheaper than interactive requests, but results may take a long time to arrive.
+                print("\n[Step 3/5] Submitting Report Part 1, Part 2 and Mermaid Diagram as a batch...")
+                batch_results = generate_content_batch(
+                    [
+                        ("part1", part1_prompt_template, report_model, report_generation_config, safety_settings_config),
+                        ("part2", part2_prompt_template, report_model, report_generation_config, safety_settings_config),
+                        ("mermaid", mermaid_prompt_template, other_model, other_generation_config, safety_settings_config),
+                    ],
+                    all_scripts_content,
+                    batch_poll_interval_seconds
+                )
+                part_1_result = batch_results["part1"]
+                part_2_result = batch_results["part2"]
+                mermaid_result = batch_results["mermaid"]
+            else:
+                # --- Generate Report Parts and Mermaid Diagram Concurrently ---
+                # The three requests are independent, so they are issued together and the total
+                # wait is roughly that of the slowest generation instead of the sum of all three.
+                async def generate_report_part(prompt_template, part_label, output_filename):
+                    """Generates a report part; when streaming, it is written to disk as it arrives."""
+                    result = await generate_content_async(
+                        build_prompt(prompt_template, report_cache),
+                        report_model,
+                        report_generation_config,
+                        safety_settings_config,
+                        f"CTI Report {part_label}",
+                        cached_content=report_cache,
+                        stream=stream_reports
+                    )
+                    if not stream_reports:
+                        return result
+                    await save_report_part_stream_async(*result, output_filename, part_label, report_timestamp)
+                    return None # Already saved
 
+                async def run_all():
+                    """Runs the Part 1, Part 2 and Mermaid generations concurrently."""
+                    p1 = generate_report_part(part1_prompt_template, "Part 1", output_filename_part_1)
+                    p2 = generate_report_part(part2_prompt_template, "Part 2", output_filename_part_2)
+                    mermaid = generate_content_async(
+                        build_prompt(mermaid_prompt_template, other_cache),
+                        other_model,
+                        other_generation_config,
+                        safety_settings_config,
+                        "Mermaid Diagram",
+                        cached_content=other_cache
+                    )
+                    return await asyncio.gather(p1, p2, mermaid)
 
-    if chat:
-        while True:
-            try:
-                user_input = input("\nAsk Gemini > ")
-                if user_input.lower() in ['exit', 'quit']:
-                    break
+                print("\n[Step 3/5] Starting Report Part 1, Part 2 and Mermaid Diagram generation...")
+                part_1_result, part_2_result, mermaid_result = event_loop.run_until_complete(run_all())
 
-                # Prepend context to the user input for the chat? Or rely on chat history?
-                # For simplicity, let's just send the user input directly to the model.
-                # If the model struggles with context, you might need to engineer the chat prompt.
-                response = chat.send_message(user_input)
-                print(f"Gemini > {response.text}")
+            if part_1_result is not None or part_2_result is not None:
+                print(f"\n[Step 4/5] Saving Report Part 1 and Part 2...")
+            # Streamed parts (None here) were already written while they were generated
+            if part_1_result is not None:
+                save_report_part(*part_1_result, output_filename_part_1, "Part 1", report_timestamp)
+            if part_2_result is not None:
+                save_report_part(*part_2_result, output_filename_part_2, "Part 2", report_timestamp)
 
-            except Exception as e:
-                print(f"Error during chat interaction: {e}")
-                # Optionally, break the loop on persistent errors
-                # break
+            print(f"\n[Step 5/5] Saving Mermaid Diagram...")
+            save_mermaid_diagram(*mermaid_result, mermaid_filename, report_timestamp)
+
+
+        # --- Chat System ---
+        print("\n--- Starting Chat System ---")
+        print("You can now ask questions about the malware scripts and generated report content.")
+        print("Type 'exit' or 'quit' to end the chat.")
+
+        # Start the chat session, resuming the previous conversation if it is recent enough.
+        # Using the 'other_model' for chat as it might be configured differently from the report model.
+        # When the script content is in a context cache, the chat model is bound to it so questions
+        # can refer to the scripts without sending them again.
+        # The chat may outlive the context cache's TTL, so its expiry is pushed back before the
+        # session starts and again before every message
+        keep_cache_alive = None
+        if other_cache:
+            keep_cache_alive = functools.partial(extend_context_cache, other_cache, context_cache_ttl_seconds)
+            keep_cache_alive()
+        try:
+            chat_model = build_model(other_model, other_generation_config, safety_settings_config, other_cache)
+            chat_history = load_chat_history(CHAT_HISTORY_FILE, chat_history_ttl_seconds) if persist_chat_history else []
+            chat = chat_model.start_chat(history=chat_history)
+            print("Chat session started.")
+        except Exception as e:
+             print(f"\nError initializing chat model: {e}")
+             chat = None # Disable chat if initialization fails
+
+
+        if chat:
+            event_loop.run_until_complete(chat_loop(chat, persist_chat_history, keep_cache_alive))
 
-    print("\n--- Chat System Ended ---")
+        print("\n--- Chat System Ended ---")
+
+    finally:
+        # --- Clean Up Context Caches ---
+        # Caches are billed for storage until they expire, so remove them once we are done.
+        for cache in context_caches.values():
+            try:
+                cache.delete()
+            except Exception as e:
+                print(f"Warning: Could not delete context cache {cache.name}: {e}")
+        close_event_loop(event_loop)
     print("\n--- Script Finished ---")